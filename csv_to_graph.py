@@ -1,19 +1,27 @@
 #!
 """
-Loads a constituent CSV file and converts it to a newtorkx graph in weitghted edgelist format.
+Loads a constituent CSV file and converts it to a networkx graph, written in GML or weighted edgelist format.
 Can be used both as a command-line script and as a python imporable module.
 """
 
 import argparse
 import logging
-from typing import Dict, List
+import re
+import string
+from typing import Callable, Dict, FrozenSet, Iterator, List, Match, Pattern, Union
 
 import networkx as nx
 import pandas as pd
 
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pacsv = None
+
 __author__ = "Luca Crema"
 __version__ = "1.1"
-__all__ = ["parse_csv"]
+__all__ = ["parse_edges", "parse_csv"]
 
 
 logger: logging.Logger = logging.getLogger(__name__)
@@ -38,6 +46,8 @@ CURRENCY_CONVERSION_RATES: Dict[str, float] = {
     "MYR": 0.2068,
     "IDR": 0.00006069,
 }
+# Same rates as a Series, mapped over a column with a single hash table lookup
+_RATES_SERIES: pd.Series = pd.Series(CURRENCY_CONVERSION_RATES, dtype="float64")
 
 # List of values that are considered as invalid
 TICKER_REGEX: str = r"([a-zA-Z0-9\.]{1,8})+"
@@ -45,10 +55,18 @@ WEIGHT_REGEX: str = r"[\+\-]?([0-9]*\.)?[0-9]+"
 ISIN_REGEX: str = r"[a-zA-Z]{2}[0-9]{4,10}"
 LOCATION_REGEX: str = r"(\.|-| )+.*"
 
+# TICKER_REGEX is only anchored at the start, so a ticker is valid iff its first character is one of these
+TICKER_CHARACTERS: FrozenSet[str] = frozenset(string.ascii_letters + string.digits + ".")
+
+# Regexes are compiled once instead of on every pandas string operation
+_LOCATION_RE: Pattern[str] = re.compile(LOCATION_REGEX)
+# Matches locations, "CASH_" and cash tickers ("0") so components are cleaned in a single pass
+_COMPONENT_TICKER_RE: Pattern[str] = re.compile(f"{LOCATION_REGEX}|CASH_|0")
+
 
 def _make_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
-        description="Loads a CSV file and converts it into a networkx graph in weitghted edgelist format.",
+        description="Loads a CSV file and converts it into a networkx graph in GML or weighted edgelist format.",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
     parser.add_argument("filename", metavar="PATH", type=str, nargs="?", help="path of the CSV file to parse.")
@@ -61,6 +79,15 @@ def _make_parser() -> argparse.ArgumentParser:
         default="out_graph",
         help="output filename (without extension).",
     )
+    parser.add_argument(
+        "-f",
+        "--format",
+        type=str,
+        nargs="?",
+        default="gml",
+        choices=["gml", "edgelist"],
+        help="output format, edgelist skips building the networkx graph.",
+    )
     parser.add_argument(
         "--default-currency",
         metavar="CURRENCY",
@@ -75,6 +102,14 @@ def _make_parser() -> argparse.ArgumentParser:
         action="store_true",
         help="do not convert currencies to euros.",
     )
+    parser.add_argument(
+        "--weight-dtype",
+        type=str,
+        nargs="?",
+        default="float64",
+        choices=["float32", "float64"],
+        help="floating point type of the market values, float32 halves their memory at the cost of precision.",
+    )
     parser.add_argument(
         "-log",
         "--loglevel",
@@ -146,26 +181,148 @@ def _make_parser() -> argparse.ArgumentParser:
         default='"',
         help="quote character of strings for the input CSV file.",
     )
+    csv_parsing_group.add_argument(
+        "--chunksize",
+        metavar="ROWS",
+        type=int,
+        nargs="?",
+        default=None,
+        help="read the CSV file in chunks of ROWS rows, dropping the rows without market value and the duplicates of "
+        "each chunk before reading the next one. The parser still reads whole blocks of the file.",
+    )
     return parser
 
 
+def _read_csv(
+    filename: str,
+    columns: List[str],
+    delimiter: str = ",",
+    quotechar: str = '"',
+    chunksize: int = None,
+    use_pyarrow: bool = True,
+) -> Iterator[pd.DataFrame]:
+    """
+    Reads the given columns of a CSV file as strings, in chunks of `chunksize` rows or all at once.
+
+    Uses the multithreaded pyarrow CSV reader when it is installed and `use_pyarrow` is set, otherwise the pandas C
+    parser. In both cases the file is memory-mapped instead of being read through a buffered stream.
+    The pyarrow reader is stricter, it raises `pyarrow.ArrowInvalid` on rows with a missing field.
+    """
+    if pacsv is None or not use_pyarrow:
+        with pd.read_csv(
+            filename,
+            sep=delimiter,
+            quotechar=quotechar,
+            encoding="utf-8",
+            na_values=" ",
+            usecols=columns,
+            dtype=str,
+            engine="c",
+            memory_map=True,
+            chunksize=chunksize or None,
+            iterator=True,
+        ) as reader:
+            yield from reader
+        return
+    # Arrow tokenizes and converts the blocks in parallel on all the available cores by default
+    read_options = pacsv.ReadOptions(block_size=8 << 20)
+    # Quoted values may span lines, like they can for the pandas parser
+    parse_options = pacsv.ParseOptions(delimiter=delimiter, quote_char=quotechar, newlines_in_values=True)
+    convert_options = pacsv.ConvertOptions(
+        include_columns=columns,
+        column_types={column: pa.string() for column in columns},
+        # Same missing values as the pandas parser
+        null_values=[*pacsv.ConvertOptions().null_values, " "],
+        strings_can_be_null=True,
+    )
+    with pa.memory_map(filename) as source:
+        if not chunksize:
+            yield pacsv.read_csv(
+                source, read_options=read_options, parse_options=parse_options, convert_options=convert_options
+            ).to_pandas()
+            return
+        # Stream the blocks and cut them into chunks of exactly chunksize rows, the last one can be shorter
+        reader = pacsv.open_csv(
+            source, read_options=read_options, parse_options=parse_options, convert_options=convert_options
+        )
+        rest: pa.Table = reader.schema.empty_table()
+        chunks: int = 0
+        for batch in reader:
+            rest = pa.concat_tables([rest, pa.Table.from_batches([batch])])
+            while rest.num_rows >= chunksize:
+                yield rest.slice(0, chunksize).to_pandas()
+                rest, chunks = rest.slice(chunksize), chunks + 1
+        # A file without rows has no batches, it still yields an empty chunk with the wanted columns
+        if rest.num_rows > 0 or chunks == 0:
+            yield rest.to_pandas()
+
+
+def _read_rows(
+    filename: str,
+    columns: List[str],
+    market_value_column: str,
+    delimiter: str = ",",
+    quotechar: str = '"',
+    chunksize: int = None,
+    use_pyarrow: bool = True,
+) -> pd.DataFrame:
+    """
+    Reads the given columns of a CSV file, removing the rows without market value and the duplicates of a chunk as
+    soon as it is read.
+
+    Files that the pyarrow reader rejects are read again with the pandas parser, which accepts them like before.
+    """
+    try:
+        return pd.concat(
+            [
+                chunk.dropna(subset=[market_value_column]).drop_duplicates()
+                for chunk in _read_csv(
+                    filename,
+                    columns,
+                    delimiter=delimiter,
+                    quotechar=quotechar,
+                    chunksize=chunksize,
+                    use_pyarrow=use_pyarrow,
+                )
+            ],
+            ignore_index=True,
+        )
+    except Exception as error:
+        if pacsv is None or not use_pyarrow or not isinstance(error, pa.ArrowInvalid):
+            raise
+        logger.warning("pyarrow could not parse %s (%s), reading it with pandas.", filename, error)
+        return _read_rows(filename, columns, market_value_column, delimiter, quotechar, chunksize, use_pyarrow=False)
+
+
 def _to_uniform_currency(value: float, currency: str, ignore_unknown: bool = False) -> float:
     """
     Convert a value in a given currency to euros.
     """
-    if currency not in CURRENCY_CONVERSION_RATES:
+    rate = CURRENCY_CONVERSION_RATES.get(currency)
+    if rate is None:
         # Return a default 0.0 value if the currency is unknown and we don't care about it
         if ignore_unknown:
             return 0.0
         raise ValueError(f"Unknown currency `{currency}`.")
-    return value * CURRENCY_CONVERSION_RATES[currency]
+    return value * rate
 
 
-def _replace(df: pd.DataFrame, column: str, pattern: str, replacement: str) -> pd.DataFrame:
+def _replace(
+    df: pd.DataFrame,
+    column: str,
+    pattern: Union[str, Pattern[str]],
+    replacement: Union[str, Callable[[Match[str]], str]],
+) -> pd.DataFrame:
     """
     Replace a pattern in a dataframe.
+
+    The same ticker appears on many rows, so every distinct value is replaced only once and then mapped back.
     """
-    df[column] = df[column].str.replace(pattern, replacement, regex=True)
+    values: pd.Series = pd.Series(df[column].dropna().unique())
+    # Mapping through an empty dict would turn the column into floats
+    if values.empty:
+        return df
+    df[column] = df[column].map(dict(zip(values, values.str.replace(pattern, replacement, regex=True))))
     return df
 
 
@@ -174,58 +331,79 @@ def _fill_column(df: pd.DataFrame, missing_column: str, filler_column: str) -> p
     Replaces empty "missing_column" values with the same-column value from another row that has
     the same "filler_column" value.
     """
-    df.loc[df[missing_column].isnull(), missing_column] = df.loc[df[missing_column].isnull(), filler_column].map(
-        df.loc[df[filler_column].notnull()].groupby(filler_column).aggregate({missing_column: "first"})[missing_column]
+    # First known "missing_column" value of every "filler_column" value
+    known: pd.Series = (
+        df[[filler_column, missing_column]]
+        .dropna()
+        .drop_duplicates(subset=filler_column)
+        .set_index(filler_column)[missing_column]
     )
+    df[missing_column] = df[missing_column].fillna(df[filler_column].map(known))
     return df
 
 
-def _filter_regex(df: pd.DataFrame, column: str, regex: str) -> pd.DataFrame:
+def _is_ticker(tickers: pd.Series) -> pd.Series:
+    """
+    Returns a boolean mask of the values that match `TICKER_REGEX`, without running the regex engine.
+    """
+    return tickers.str[:1].isin(TICKER_CHARACTERS)
+
+
+def _share_categories(df: pd.DataFrame, columns: List[str]) -> pd.DataFrame:
     """
-    Filters a dataframe by a regex.
+    Converts the columns to categoricals with the same categories, so that equal values are stored only once.
     """
-    return df[df[column].notnull() & df[column].str.match(regex)]
+    # Object categories are handed out as the same str instances on every access
+    categories = pd.Index(pd.unique(pd.concat([df[column] for column in columns])), dtype=object)
+    return df.assign(**{column: pd.Categorical(df[column], categories=categories) for column in columns})
 
 
 def _describe(df: pd.DataFrame, description: str = None) -> pd.DataFrame:
     """
     Outputs the describe method of a dataframe on the logger at DEBUG level.
     """
+    # Describing scans the whole dataframe, skip it when it would not be logged anyway
+    if not logger.isEnabledFor(logging.DEBUG):
+        return df
     if description:
         logger.debug(description)
-    logger.debug(f"\n{df.describe(include='all')}")
+    logger.debug("\n%s", df.describe(include="all"))
     return df
 
 
-def _to_float(value: str) -> float:
+def _to_numeric(df: pd.DataFrame, column: str, dtype: str = "float64") -> pd.DataFrame:
     """
-    Convert a string to a float.
+    Converts a column of strings to floats of the given type, the invalid values become 0.0.
+    """
+    return df.assign(**{column: pd.to_numeric(df[column], errors="coerce").fillna(0.0).astype(dtype)})
 
-    Returns:
-        The float value of the string if it is a valid float, else 0.0.
+
+def _to_numeric_if_valid(df: pd.DataFrame, column: str) -> pd.DataFrame:
     """
-    try:
-        return float(value)
-    except ValueError:
-        return 0.0
+    Converts a column of strings to float64 only if all of them are valid numbers, like the pandas type inference.
+    """
+    values: pd.Series = pd.to_numeric(df[column], errors="coerce")
+    if values.notnull().all():
+        return df.assign(**{column: values})
+    return df
 
 
 def _convert_currency(df: pd.DataFrame, market_value_column: str, currency_column: str) -> pd.DataFrame:
     """
     Converts the currency to the default one and changes the currency column value.
     """
-    df[[market_value_column, currency_column]] = df[[market_value_column, currency_column]].apply(
-        lambda row: (
-            _to_uniform_currency(_to_float(row[market_value_column]), row[currency_column]),
-            DEFAULT_CURRENCY,
-        ),
-        axis=1,
-        result_type="broadcast",
-    )
+    # Look up all the conversion rates at once instead of converting row by row
+    rates: pd.Series = df[currency_column].map(_RATES_SERIES)
+    unknown_currencies: pd.Series = df.loc[rates.isnull(), currency_column]
+    if not unknown_currencies.empty:
+        raise ValueError(f"Unknown currency `{unknown_currencies.iloc[0]}`.")
+    # Keep the market value type, multiplying by float64 rates would upcast it
+    df[market_value_column] = df[market_value_column] * rates.astype(df[market_value_column].dtype)
+    df[currency_column] = DEFAULT_CURRENCY
     return df
 
 
-def parse_csv(
+def parse_edges(
     filename: str,
     etf_ticker_column: str = DEFAULT_ETF_TICKER_COLUMN,
     component_ticker_column: str = DEFAULT_COMPONENT_TICKER_COLUMN,
@@ -235,20 +413,22 @@ def parse_csv(
     delimiter: str = ",",
     quotechar: str = '"',
     default_currency: str = "USD",
+    weight_dtype: str = "float64",
+    chunksize: int = None,
     **kwargs,
-) -> nx.DiGraph:
+) -> pd.DataFrame:
     """
-    Parses a dataset in CSV format and returns a Netoworkx DiGraph.
+    Parses a dataset in CSV format and returns its cleaned edges.
 
     Parameters:
         filename: path of the CSV file to parse.
+        weight_dtype: numpy floating point type used to store the market values.
+        chunksize: number of rows reduced at a time, the whole file is read at once if not given.
 
     Returns:
-        A Networkx DiGraph with edges containing market value as 'weight' attribute.
+        A DataFrame with the ETF ticker, component ticker and 'weight' (market value) columns, one row per edge.
     """
-    # Load CSV file
-    df: pd.DataFrame = pd.read_csv(filename, sep=delimiter, quotechar=quotechar, encoding="utf-8", na_values=" ")
-    # Filter out the unwanted columns
+    # Only the wanted columns are parsed, the others are skipped by the CSV tokenizer
     wanted_columns: List[str] = [
         etf_ticker_column,
         component_ticker_column,
@@ -256,44 +436,54 @@ def parse_csv(
         currency_column,
         isin_column,
     ]
-    df = df[wanted_columns]
+    # Load CSV file, removing the rows without market value and the duplicates of a chunk as soon as it is read
+    df: pd.DataFrame = _read_rows(
+        filename, wanted_columns, market_value_column, delimiter=delimiter, quotechar=quotechar, chunksize=chunksize
+    )
 
     df = (
+        df.pipe(_describe, "Filtered rows without market value")
         # Replace empty strings with None
-        df.pipe(lambda df: df.where(df.notnull(), None))
-        # Remove rows without market value
-        .pipe(lambda df: df.dropna(subset=[market_value_column]))
-        .pipe(_describe, "Filtered rows without market value")
-        # Remove exact duplicate rows
+        .pipe(lambda df: df.where(df.notnull(), None))
+        # Compare market values as numbers ("1" and "1.00" are the same) when they are all valid numbers
+        .pipe(_to_numeric_if_valid, market_value_column)
+        # Remove exact duplicate rows, also the ones from different chunks
         .pipe(lambda df: df.drop_duplicates())
         .pipe(_describe, "Filtered exactly duplicate rows")
         # Fill missing currency values
         .pipe(lambda df: df.fillna(value={currency_column: default_currency}, inplace=False))
         .pipe(_describe, "Filled NaN currency values")
         # Remove ticker columns location (like .JP .AU .HK )
-        .pipe(_replace, etf_ticker_column, LOCATION_REGEX, "")
-        .pipe(_replace, component_ticker_column, LOCATION_REGEX, "")
-        .pipe(_describe, "Removed ticker locations")
-        # Remove "CASH" from tickers
-        .pipe(_replace, component_ticker_column, "CASH_", "")
-        # Rename cash tickers ("0") to their currency
-        .pipe(_replace, component_ticker_column, "0", default_currency)
-        .pipe(_describe, "Renamed cash constituents")
+        .pipe(_replace, etf_ticker_column, _LOCATION_RE, "")
+        # Also remove "CASH" from component tickers and rename cash tickers ("0") to their currency
+        .pipe(
+            _replace,
+            component_ticker_column,
+            _COMPONENT_TICKER_RE,
+            lambda match: default_currency if match.group() == "0" else "",
+        )
+        .pipe(_describe, "Removed ticker locations and renamed cash constituents")
         # Fill missing tickers with the ticker from other components with the same ISIN
         .pipe(_fill_column, missing_column=component_ticker_column, filler_column=isin_column)
         # Fill missing isin with the isin from other components with the same ticker
         .pipe(_fill_column, missing_column=isin_column, filler_column=component_ticker_column)
         .pipe(_describe, "Filled ticker and ISIN columns")
-        # Filter out the invalid tickers with the regex
-        .pipe(_filter_regex, column=etf_ticker_column, regex=TICKER_REGEX)
-        .pipe(_filter_regex, column=component_ticker_column, regex=TICKER_REGEX)
-        .pipe(_describe, "Filtered invalid tickers")
-        # Remove indices (etf tickers that start with a dot)
-        .pipe(lambda df: df[df[etf_ticker_column].str.startswith(".") == False])  # noqa: E712
-        .pipe(_describe, "Removed indices")
+        # Filter out the invalid tickers and the indices (etf tickers that start with a dot) with a single selection
+        .pipe(
+            lambda df: df[
+                _is_ticker(df[etf_ticker_column])
+                & _is_ticker(df[component_ticker_column])
+                & ~df[etf_ticker_column].str.startswith(".", na=False)
+            ]
+        )
+        .pipe(_describe, "Filtered invalid tickers and indices")
+        # Tickers are final, from now on store them as codes of categories shared by both columns
+        .pipe(_share_categories, [etf_ticker_column, component_ticker_column])
+        # Parse market values, the invalid ones are counted as 0.0
+        .pipe(_to_numeric, market_value_column, weight_dtype)
     )
     # Avoid currency conversion if not wanted
-    if "no-currency-conversion" not in kwargs or not kwargs["no-currency-conversion"]:
+    if not kwargs.get("no_currency_conversion", False):
         df = (
             # Uniform currencies
             df.pipe(
@@ -303,26 +493,49 @@ def parse_csv(
             ).pipe(_describe, f"Converted all currencies to {DEFAULT_CURRENCY}")
         )
     # Rename market value column to weight
-    df.rename(columns={market_value_column: "weight"}, inplace=True)
-    # Create the networkx graph edges
-    return nx.from_pandas_edgelist(
-        df,
-        source=etf_ticker_column,
-        target=component_ticker_column,
-        edge_attr="weight",
-        create_using=nx.DiGraph(),
+    return (
+        df[[etf_ticker_column, component_ticker_column, market_value_column]]
+        .rename(columns={market_value_column: "weight"})
+        # Cleaned tickers can make several rows of the same edge, keep the last one like the DiGraph does
+        .drop_duplicates(subset=[etf_ticker_column, component_ticker_column], keep="last")
     )
 
 
+def parse_csv(filename: str, **kwargs) -> nx.DiGraph:
+    """
+    Parses a dataset in CSV format and returns a Networkx DiGraph.
+
+    Parameters:
+        filename: path of the CSV file to parse.
+        kwargs: the column names and parsing options of `parse_edges`.
+
+    Returns:
+        A Networkx DiGraph with edges containing market value as 'weight' attribute.
+    """
+    df: pd.DataFrame = parse_edges(filename, **kwargs)
+    # Create the networkx graph edges straight from the columns, without the per-row attribute handling
+    etf_tickers, component_tickers, weights = (df[column].tolist() for column in df.columns)
+    G: nx.DiGraph = nx.DiGraph()
+    G.add_weighted_edges_from(zip(etf_tickers, component_tickers, weights))
+    return G
+
+
 def main():
     """
     Parses the command line arguments, calls the `parse_csv` function and outputs the graph to a gml file.
+    With the edgelist format the edges from `parse_edges` are written directly, without building the graph.
     """
     parser = _make_parser()
     args = parser.parse_args()  # Parse command line arguments
     logging.basicConfig(level=args.loglevel.upper())
 
-    nx.write_gml(parse_csv(**vars(args)), f"{args.output}.gml")
+    if args.format == "edgelist":
+        parse_edges(**vars(args)).to_csv(f"{args.output}.edgelist", sep=" ", header=False, index=False)
+        logger.info("Done!")
+        return
+    # Write through a large buffer to avoid a syscall every few lines of GML
+    with open(f"{args.output}.gml", "wb", buffering=1 << 20) as outfile:
+        nx.write_gml(parse_csv(**vars(args)), outfile)
     logger.info("Done!")
 
 
@@ -1,20 +1,76 @@
+import heapq
+import os
+import pickle
 import random
-from typing import Any, List, Set
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
+from operator import itemgetter
+from typing import Any, List, Optional, Set, Tuple
 
 import igraph
 import networkx as nx
+import numpy as np
 import scipy
 
 __author__ = "Luca Crema, Riccardo Crociani"
 __version__ = "0.2"
-__all__ = ["max_k_nodes", "betweenness_centrality_percent", "all_neighbors", "connected_random_subgraph"]
+__all__ = [
+    "load_graph",
+    "max_k_nodes",
+    "compute_capitalization",
+    "betweenness_centrality_percent",
+    "all_neighbors",
+    "connected_random_subgraph",
+]
+
+
+def load_graph(filename: str) -> nx.Graph:
+    """
+    Reads the GML graph in filename, caching it in the binary filename.pkl that is read instead while it is newer.
+    """
+    cache_filename = filename + ".pkl"
+    if os.path.exists(cache_filename) and os.path.getmtime(cache_filename) >= os.path.getmtime(filename):
+        try:
+            with open(cache_filename, "rb") as f:
+                return pickle.load(f)
+        except Exception:
+            # A cache that can't be read is rebuilt from the GML
+            pass
+    G = nx.read_gml(filename)
+    try:
+        # Write a temporary file and move it in place, so a failed write never leaves a truncated cache behind
+        fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(cache_filename) or ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(G, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_filename, cache_filename)
+        except BaseException:
+            os.remove(temp_filename)
+            raise
+    except OSError:
+        # The graph is still returned when the cache can't be written, e.g. in a read-only directory
+        pass
+    return G
 
 
 def max_k_nodes(G: nx.Graph, k: int, attribute: str) -> List[Any]:
     """
     Finds the k nodes with the highest value of the given attribute.
     """
-    return sorted(G.nodes(), key=lambda x: G.nodes[x][attribute], reverse=True)[:k]
+    # Keeps a heap of k nodes instead of sorting all of them
+    return [node for node, _ in heapq.nlargest(k, G.nodes(data=attribute), key=itemgetter(1))]
+
+
+def compute_capitalization(G: nx.DiGraph):
+    """
+    Adds the 'capitalization' attribute to every node, which is the sum of the incoming edges weights.
+    """
+    # Accumulate every edge weight on its target in a single pass over the edges
+    capitalization = dict.fromkeys(G.nodes(), 0)
+    for _, target, weight in G.edges(data="weight"):
+        capitalization[target] += weight
+    nx.set_node_attributes(G, capitalization, "capitalization")
 
 
 def betweenness_centrality_percent(G: nx.Graph, percentage: float = 0.1, normalized: bool = True) -> dict:
@@ -32,12 +88,12 @@ def all_neighbors(G: nx.DiGraph, n: str) -> Set[Any]:
     """
     Returns a set of successors and predecessors of node n in the DiGraph G.
     """
-    return set(list(G.successors(n)) + list(G.predecessors(n)))
+    return set(chain(G.successors(n), G.predecessors(n)))
 
 
-def connected_random_subgraph(G: nx.Graph, n: int) -> nx.Graph:
+def _random_component_node(G: nx.Graph, n: int) -> Any:
     """
-    Samples n connected vertices from a connected component of G.
+    Returns a random node of a random connected component of G with more than n nodes.
     """
     # List of connected components with more than n nodes
     components = [g for g in nx.weakly_connected_components(G) if len(g) > n]
@@ -45,25 +101,51 @@ def connected_random_subgraph(G: nx.Graph, n: int) -> nx.Graph:
     if len(components) == 0:
         raise ValueError(f"There are no connected components with more than {n=} nodes.")
     # Sample one of the random components
-    random_component: Set = random.choice(list(components))
-    # Sample a random node
-    start_node = random.choice(list(random_component))
+    random_component: Set = random.choice(components)
+    # Sample a random node, skipping to it instead of copying the component into a list
+    return next(islice(random_component, random.randrange(len(random_component)), None))
+
+
+def connected_random_subgraph(G: nx.Graph, n: int, from_edge: bool = False) -> nx.Graph:
+    """
+    Samples n connected vertices from a connected component of G.
+
+    With from_edge the sample grows from the source of a random edge instead of a random node of a component with
+    more than n nodes, which skips labelling the connected components of G, but returns fewer than n vertices when
+    that edge's component is smaller.
+
+    Returns:
+        A standalone copy of the subgraph induced by the sampled vertices, not a view of G.
+    """
+    if from_edge:
+        if G.number_of_edges() == 0:
+            raise ValueError("There are no edges to start the sample from.")
+        # Sample a random edge, its source is never an isolated node
+        start_node, _ = next(islice(G.edges(), random.randrange(G.number_of_edges()), None))
+    else:
+        start_node = _random_component_node(G, n)
     # Initialize selected and candidate nodes
     selected_nodes: List[Any] = [start_node]
-    candidate_nodes: Set[Any] = all_neighbors(G, start_node)
-    while len(selected_nodes) < n and len(candidate_nodes) > 0:
-        # Avoid random selection if only one node is available
-        if len(candidate_nodes) == 1:
-            selected_candidate = candidate_nodes.pop()
-        else:
-            selected_candidate = random.choice(list(candidate_nodes))
-            # Remove the newly selected node from candidates
-            candidate_nodes.remove(selected_candidate)
+    selected_set: Set[Any] = {start_node}
+    # Candidates are kept in a list to sample them in O(1) and in a set for membership tests
+    candidate_set: Set[Any] = all_neighbors(G, start_node) - selected_set
+    candidate_list: List[Any] = list(candidate_set)
+    while len(selected_nodes) < n and len(candidate_list) > 0:
+        # Swap a random candidate with the last one and pop it
+        i = random.randrange(len(candidate_list))
+        candidate_list[i], candidate_list[-1] = candidate_list[-1], candidate_list[i]
+        selected_candidate = candidate_list.pop()
+        candidate_set.remove(selected_candidate)
         # Add the newly selected node to selected nodes
         selected_nodes.append(selected_candidate)
-        # Add the newly selected node's neighbors to candidates (without already selected nodes)
-        candidate_nodes.update(all_neighbors(G, selected_candidate) - set(selected_nodes))
-    return nx.subgraph(G, selected_nodes)
+        selected_set.add(selected_candidate)
+        # Add the newly selected node's neighbors to candidates (without already selected or candidate nodes), the
+        # membership tests already skip the nodes that are both successors and predecessors, so no set is built
+        for neighbor in chain(G.successors(selected_candidate), G.predecessors(selected_candidate)):
+            if neighbor not in selected_set and neighbor not in candidate_set:
+                candidate_list.append(neighbor)
+                candidate_set.add(neighbor)
+    return G.subgraph(selected_nodes).copy()
 
 
 def closeness_centrality_matrix(G):
@@ -72,65 +154,84 @@ def closeness_centrality_matrix(G):
 
     Source: https://medium.com/@pasdan/closeness-centrality-via-networkx-is-taking-too-long-1a58e648f5ce
     """
-    A = nx.adjacency_matrix(G).tolil()  # adjacency matrix converted into list of lists
-    # Run floyd-warshall algorithm to find shortest paths
-    D = scipy.sparse.csgraph.floyd_warshall(A, directed=True, unweighted=False)
+    # Weighted adjacency matrix as float64 CSR, the format csgraph works on, so it is not converted again
+    A = nx.adjacency_matrix(G, dtype=np.float64, weight="weight").tocsr()
+    # Find all the shortest paths, on sparse graphs this runs Dijkstra (or Johnson with negative weights) from every
+    # node, which is much faster than the cubic Floyd-Warshall
+    D = scipy.sparse.csgraph.shortest_path(A, method="auto", directed=True, unweighted=False)
     node_list = list(G.nodes())  # Used to name the nodes
-    centralities = {}
     n = D.shape[0]  # Number of nodes
-    for node_index in range(0, n):
-        cc = 0.0
-        possible_paths = D[node_index, :]
-        shortest_paths = list(filter(lambda x: x != float("inf"), possible_paths))
-
-        total = sum(shortest_paths)
-        n_shortest_paths = len(shortest_paths) - 1
-        if total > 0.0 and n > 1:
-            s = n_shortest_paths / (n - 1)
-            cc = (n_shortest_paths / total) * s
-        centralities[node_list[node_index]] = cc
-    return centralities
+    # Reduce every row of the distance matrix at once, ignoring unreachable nodes
+    reachable = np.isfinite(D)
+    n_shortest_paths = reachable.sum(axis=1) - 1
+    totals = np.where(reachable, D, 0.0).sum(axis=1)
+    centralities = np.zeros(n)
+    if n > 1:
+        mask = totals > 0.0
+        centralities[mask] = (n_shortest_paths[mask] / totals[mask]) * (n_shortest_paths[mask] / (n - 1))
+    return dict(zip(node_list, centralities.tolist()))
 
 
 def max_out_degree_vertex(G: nx.DiGraph):
     """
     Returns the vertex with the maximum out-degree in G.
     """
-    return max(G.nodes(), key=lambda x: G.out_degree(x))
+    return max(G.out_degree(), key=itemgetter(1))[0]
 
 
 def max_in_degree_vertex(G: nx.DiGraph):
     """
     Returns the vertex with the maximum in-degree in G.
     """
-    return max(G.nodes(), key=lambda x: G.in_degree(x))
+    return max(G.in_degree(), key=itemgetter(1))[0]
 
 
 def min_in_degree_vertex(G: nx.DiGraph):
     """
     Returns the vertex with the minimum in-degree in G.
     """
-    return min(G.nodes(), key=lambda x: G.in_degree(x))
+    return min(G.in_degree(), key=itemgetter(1))[0]
 
 
-def longest_path(G) -> List[str]:
+def longest_path(G, block_size: int = 1024) -> List[str]:
     """
     Returns the longest path of G.
+
+    The shortest paths are found by scipy with Dijkstra on unit weights from block_size sources at a time, so the
+    distance and predecessor matrices never hold more than block_size rows.
     """
-    shortest_paths = dict(nx.all_pairs_shortest_path(G))
-    max_len = 0
-    max_path = None
-    for source in shortest_paths.keys():
-        for target in shortest_paths[source].keys():
-            if len(shortest_paths[source][target]) > max_len:
-                max_len = len(shortest_paths[source][target])
-                max_path = shortest_paths[source][target]
-    return max_path
+    node_list = list(G.nodes())
+    n = len(node_list)
+    if n == 0:
+        return None
+    A = nx.adjacency_matrix(G, weight=None).tocsr()
+    max_len = -1
+    max_source = max_target = 0
+    max_predecessors = None
+    for start in range(0, n, block_size):
+        D, P = scipy.sparse.csgraph.shortest_path(
+            A,
+            directed=True,
+            unweighted=True,
+            return_predecessors=True,
+            indices=np.arange(start, min(start + block_size, n)),
+        )
+        # Unreachable targets must never be the longest
+        D[~np.isfinite(D)] = -1
+        row, target = np.unravel_index(np.argmax(D), D.shape)
+        if D[row, target] > max_len:
+            max_len = int(D[row, target])
+            max_source, max_target = int(start + row), int(target)
+            max_predecessors = P[row]
+    # Walk back from the target to the source of the longest path
+    path = [max_target]
+    while path[-1] != max_source:
+        path.append(int(max_predecessors[path[-1]]))
+    return [node_list[i] for i in reversed(path)]
 
 
 def exclusive_neighborhood(G: igraph.Graph, v: int, Vp: set):
     """
-    Used by ESU algorithm.
     Returns the set of neighbors that are not already neighbors of any node in Vp.
     """
     Nv = set(G.neighborhood(v, mode="out"))
@@ -139,34 +240,129 @@ def exclusive_neighborhood(G: igraph.Graph, v: int, Vp: set):
     return Nv - NVp
 
 
-def extend_subgraph(G: igraph.Graph, Vsubgraph: set, Vextension: set, v: int, k: int, k_subgraphs: list):
+def _neighborhood_masks(G: igraph.Graph) -> List[int]:
     """
     Used by ESU algorithm.
-    Updates Vextension and k_subgraphs.
-    """
-    if len(Vsubgraph) == k:
-        k_subgraphs.append(Vsubgraph)
-        assert 1 == len(set(G.subgraph(Vsubgraph).clusters(mode=igraph.WEAK).membership))
-        return
-    while len(Vextension) > 0:
-        w = random.choice(tuple(Vextension))
-        Vextension.remove(w)
+    Returns the out-neighborhood of every vertex (vertex included) as a bitmask, bit u is set if u is in it.
+    """
+    return [sum(1 << u for u in neighborhood) for neighborhood in G.neighborhood(mode="out")]
+
+
+def _mask_to_set(mask: int) -> set:
+    """
+    Used by ESU algorithm.
+    Returns the set of vertices whose bits are set in mask.
+    """
+    vertices = set()
+    while mask:
+        lowest = mask & -mask
+        vertices.add(lowest.bit_length() - 1)
+        mask ^= lowest
+    return vertices
+
+
+def extend_subgraph(
+    G: igraph.Graph,
+    Vsubgraph: set,
+    Vextension: set,
+    v: int,
+    k: int,
+    k_subgraphs: list,
+    masks: Optional[List[int]] = None,
+):
+    """
+    Used by ESU algorithm.
+    Updates k_subgraphs.
+
+    The recursion of ESU is unrolled on an explicit stack, visited depth-first. The subgraph, its extension and its
+    neighborhood are carried as bitmasks over the vertex indices, masks are the ones of _neighborhood_masks(G).
+    """
+    if masks is None:
+        masks = _neighborhood_masks(G)
+    # Only vertices with a greater index than the root can extend the subgraph
+    higher_mask = ~((1 << (v + 1)) - 1)
+    neighborhood_mask = 0
+    for u in Vsubgraph:
+        neighborhood_mask |= masks[u]
+    stack: List[Tuple[int, int, int, int]] = [
+        (sum(1 << u for u in Vsubgraph), sum(1 << u for u in Vextension), neighborhood_mask, len(Vsubgraph))
+    ]
+    while len(stack) > 0:
+        subgraph_mask, extension_mask, neighborhood_mask, size = stack.pop()
+        if size == k:
+            subgraph = _mask_to_set(subgraph_mask)
+            k_subgraphs.append(subgraph)
+            assert 1 == len(set(G.subgraph(subgraph).clusters(mode=igraph.WEAK).membership))
+            continue
+        if extension_mask == 0:
+            continue
+        # Take w out of the extension, the rest of it is visited after the subgraphs containing w
+        w_mask = extension_mask & -extension_mask
+        w = w_mask.bit_length() - 1
+        extension_mask ^= w_mask
+        stack.append((subgraph_mask, extension_mask, neighborhood_mask, size))
         # obtain the "exclusive neighborhood" Nexcl(w, vsubgraph)
-        NexclwVsubgraph = exclusive_neighborhood(G, w, Vsubgraph)
-        VpExtension = Vextension | {u for u in NexclwVsubgraph if u > v}
-        extend_subgraph(G, Vsubgraph | {w}, VpExtension, v, k, k_subgraphs)
+        exclusive_mask = masks[w] & ~neighborhood_mask
+        stack.append(
+            (
+                subgraph_mask | w_mask,
+                extension_mask | (exclusive_mask & higher_mask),
+                neighborhood_mask | masks[w],
+                size + 1,
+            )
+        )
     return
 
 
-def enumerate_subgraphs(G: igraph.Graph, k: int):
+def _esu_root(G: igraph.Graph, masks: List[int], v: int, k: int) -> list:
+    """
+    Used by ESU algorithm.
+    Returns the size k subgraphs whose smallest vertex is v.
+    """
+    k_subgraphs: list = []
+    Vextension = {u for u in G.neighbors(v, mode="out") if u > v}
+    extend_subgraph(G, {v}, Vextension, v, k, k_subgraphs, masks)
+    return k_subgraphs
+
+
+# Graph and neighborhood masks shipped once to every worker process of the parallel ESU
+_esu_graph: igraph.Graph = None
+_esu_masks: List[int] = []
+
+
+def _init_esu_worker(G: igraph.Graph, masks: List[int]):
+    """
+    Used by ESU algorithm.
+    Stores the graph and its neighborhood masks in a worker process of the parallel ESU.
+    """
+    global _esu_graph, _esu_masks
+    _esu_graph, _esu_masks = G, masks
+
+
+def _esu_worker_root(v: int, k: int) -> list:
+    """
+    Used by ESU algorithm.
+    Returns the size k subgraphs whose smallest vertex is v, on the graph stored in the worker process.
+    """
+    return _esu_root(_esu_graph, _esu_masks, v, k)
+
+
+def enumerate_subgraphs(G: igraph.Graph, k: int, max_workers: Optional[int] = 1):
     """
     Returns a list of set objects containing the vertices of each of the size k subgraphs
 
+    The subtrees rooted at each vertex are independent, with max_workers > 1 (or None for all the CPUs) they are
+    enumerated in a pool of processes, the subgraphs are still returned in the order of their root vertex.
+
     Source: https://notebook.community/ramseylab/networkscompbio/class18_motifs_python3_template
     """
-    k_subgraphs: list = []
-    for vertex_obj in G.vs:
-        v = vertex_obj.index
-        Vextension = {u for u in G.neighbors(v, mode="out") if u > v}
-        extend_subgraph(G, {v}, Vextension, v, k, k_subgraphs)
-    return k_subgraphs
+    masks = _neighborhood_masks(G)
+    if max_workers == 1:
+        return list(chain.from_iterable(_esu_root(G, masks, v, k) for v in range(G.vcount())))
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    roots = range(G.vcount())
+    # Several roots per task, so that small subtrees do not pay the inter-process round trip each
+    chunksize = max(1, len(roots) // (4 * max_workers))
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_esu_worker, initargs=(G, masks)) as executor:
+        return list(chain.from_iterable(executor.map(_esu_worker_root, roots, [k] * len(roots), chunksize=chunksize)))